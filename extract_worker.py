@@ -0,0 +1,142 @@
+"""
+Short-lived helper that renders a single ppt/pptx via powerpoint COM and
+pickles the slides list for the parent pptcat process.
+
+Powerpoint COM leaks handles and GDI memory over long runs, so each
+invocation gets a fresh process that dies clean after its file; the
+parent never touches COM at all.
+
+    python extract_worker.py --in deck.pptx --out slides.pkl
+"""
+
+import sys
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from pptcat import make_temp_dir, render_derivatives
+
+logging.basicConfig(level=logging.INFO)
+
+
+# surely these must be importable from somewhere
+msoGroup = 6 # msoShapeType Enum
+msoTrue = -1 #!!! wtf??? msoTriState Enum
+
+# powerpoint type library; early-binding it turns every attribute access
+# from an IDispatch Invoke round-trip into a direct vtable call
+PPT_TYPELIB = ('{91493440-5A91-11CF-8700-00AA0060263B}', 2, 12)
+
+# msoShapeTypes that are (hopefully) anything that isn't text
+# todo: do msoPlaceholder=14 objects have children???
+NONTEXT_TYPES = frozenset((30,1,2,20,3,27,21,7,8,5,28,24,22,23,9,31,29,10,11,16,12,13,-2,19,26))
+
+
+def powerpoint_connect():
+    """start powerpoint for this worker and register its shutdown"""
+    import atexit
+    import comtypes.client
+
+    try:
+        comtypes.client.GetModule(PPT_TYPELIB)
+    except Exception as err:
+        logging.debug('early binding unavailable (%s), using IDispatch', err)
+
+    powerpoint = comtypes.client.CreateObject("Powerpoint.Application")
+    powerpoint.DisplayAlerts = 1 # ppAlertsNone
+    atexit.register(powerpoint.Quit)
+    return powerpoint
+
+
+def extract_slides(powerpoint, fn, pool):
+
+    def walk_shapes(shapes, types=NONTEXT_TYPES):
+        # single pass: collect text AND spot non-text content, rather than
+        # re-issuing all the COM calls in a second classification walk
+        text = []
+        has_nontext = False
+        for shp in shapes:
+            t = shp.Type # one COM call, not one per comparison
+            if t==msoGroup:
+                grouptext, groupnontext = walk_shapes(shp.GroupItems, types=types)
+                text.extend(grouptext)
+                has_nontext = has_nontext or groupnontext
+                continue
+            if t in types:
+                has_nontext = True
+            # non-text shapes can still carry text (autoshapes etc)
+            if shp.HasTextFrame==msoTrue:
+                tf = shp.TextFrame
+                if tf.HasText==msoTrue:
+                    text.append(tf.TextRange.Text)
+        return text, has_nontext
+
+
+    def render_slide(height):
+        # Export insists on a real path, so reuse one scratch file per
+        # resolution and keep only the raw PNG bytes around
+        fn = os.path.join(tmp_dir, 'render_%ipx.png' % height)
+        slide.Export(fn, 'PNG', ScaleWidth=(height*16)//9, ScaleHeight=height)
+        with open(fn, 'rb') as f:
+            return f.read()
+
+
+    slides = []
+    tmp_dir = make_temp_dir()
+    logging.debug('using temp dir %s', tmp_dir)
+
+    # WithWindow=False skips the per-slide UI repaints, which also makes
+    # Export noticeably faster
+    pres = powerpoint.Presentations.Open(fn, WithWindow=False)
+    for islide, slide in enumerate(pres.Slides):
+        logging.debug('parsing slide %s', islide)
+        this = {'filename': os.path.abspath(fn),
+                'islide': islide+1, # to match Powerpoint's slide numbering
+        }
+
+        # extract text and classify in one traversal
+        text, has_nontext = walk_shapes(slide.Shapes)
+        this['text'] = text
+
+        # extract images: export once at hires (each COM Export is a full
+        # re-rasterization); thumb + fingerprint are derived on a worker
+        # thread while COM renders the next slide
+        this['hires_png'] = render_slide(height=1080)
+        this['derived'] = pool.submit(render_derivatives, this['hires_png'])
+
+        # figure out if this slide contains anything other than text
+        this['textonly'] = not has_nontext
+
+        # todo: serialize slide?
+
+        slides.append(this)
+
+    pres.Close()
+
+    # todo: cleanup tmp dir
+
+    return slides
+
+
+def main():
+    import argparse
+    import pickle
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--in', dest='infile', required=True)
+    parser.add_argument('--out', dest='outfile', required=True)
+    args = parser.parse_args()
+
+    powerpoint = powerpoint_connect()
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        slides = extract_slides(powerpoint, args.infile, pool)
+        # futures don't pickle, so resolve the derived work here
+        for slide in slides:
+            slide['thumb_png'], slide['fingerprint'] = slide.pop('derived').result()
+
+    with open(args.outfile, 'wb') as f:
+        pickle.dump(slides, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+if __name__=="__main__":
+    main()
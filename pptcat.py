@@ -13,9 +13,7 @@ v2:
 Todo:
 
 * fix textonly mis-classification cases
-* fix so all writing for a ppt file is a single transaction
 * add file metadata (author, creation date, ...)
-* enable SQLite full text search (https://charlesleifer.com/blog/using-sqlite-full-text-search-with-python/)
 * browser based search tool
 * run over everything at scion
 * free from needing PowerPoint installed
@@ -27,7 +25,19 @@ Todo:
 
 import sys
 import os
+import io
+import hashlib
+import sqlite3
+import tempfile
 import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+# everything COM lives in extract_worker.py, which runs as a short-lived
+# subprocess per file; this module never touches powerpoint directly
+
 logging.basicConfig(level=logging.INFO)
 
 SCHEMASQL = """
@@ -35,12 +45,14 @@ create table if not exists files(
   rowid integer primary key autoincrement,
   filename text not null unique,
   hash text not null unique,
+  size integer,
+  head_hash text,
   nslides integer
 );
 create table if not exists slides(
   fileid integer,
   islide integer,
-  fingerprint text,
+  fingerprint integer,
   thumb blob,
   hires blob,
   text text,
@@ -51,102 +63,84 @@ create table if not exists slides(
     on update cascade,
   unique (fileid, islide)
 );
+-- full text search over slide text, kept in sync by triggers so a
+-- search is an indexed MATCH instead of a full scan
+-- (https://charlesleifer.com/blog/using-sqlite-full-text-search-with-python/)
+create virtual table if not exists slides_fts using fts5(
+  text,
+  content='slides',
+  content_rowid='rowid',
+  tokenize='unicode61 remove_diacritics 2'
+);
+create trigger if not exists slides_fts_ai after insert on slides begin
+  insert into slides_fts(rowid, text) values (new.rowid, new.text);
+end;
+create trigger if not exists slides_fts_ad after delete on slides begin
+  insert into slides_fts(slides_fts, rowid, text) values ('delete', old.rowid, old.text);
+end;
+create trigger if not exists slides_fts_au after update on slides begin
+  insert into slides_fts(slides_fts, rowid, text) values ('delete', old.rowid, old.text);
+  insert into slides_fts(rowid, text) values (new.rowid, new.text);
+end;
 """
 
 
 def make_temp_dir():
-    import tempfile
     return tempfile.mkdtemp()
 
 
-def extract_slides(fn):
-    import comtypes.client
-
-    # surely these must be importable from somewhere
-    msoGroup = 6 # msoShapeType Enum
-    msoTrue = -1 #!!! wtf??? msoTriState Enum
-
-    def text_from_group(parent):
-        text = []
-        for child in parent.GroupItems:
-            if child.Type==msoGroup:
-                text.extend(text_from_group(child))
-            else:
-                if child.HasTextFrame==msoTrue and child.TextFrame.HasText==msoTrue:
-                    text.append(child.TextFrame.TextRange.Text)
-        return text
-
-
-    def contains_types(objs, types=(30,1,2,20,3,27,21,7,8,5,28,24,22,23,9,31,29,10,11,16,12,13,-2,19,26)):
-        # default types is (hopefully) anything that isn't text
-        # todo: do msoPlaceholder=14 objects have children???
-        for obj in objs:
-            #print(obj.Type)
-            if obj.Type in types:
-                return True
-            elif obj.Type==msoGroup:
-                if contains_types(obj.GroupItems, types=types):
-                    return True
-        return False
-
-
-    def render_slide(height):
-        from PIL import Image
-        fn = os.path.join(tmp_dir, '%i_thumb.png' % islide)
-        slide.Export(fn, 'PNG', ScaleWidth=(height*16)//9, ScaleHeight=height)
-        img = Image.open(fn)
-        img.load()
-        return img
-
-
-    slides = []
-    tmp_dir = make_temp_dir()
-    logging.debug('using temp dir %s', tmp_dir)
-
-    powerpoint = comtypes.client.CreateObject("Powerpoint.Application")
-    powerpoint.Visible = True
-    powerpoint.Presentations.Open(fn)
-    for islide, slide in enumerate(powerpoint.ActivePresentation.Slides):
-        logging.debug('parsing slide %s', islide)
-        this = {'filename': os.path.abspath(fn),
-                'islide': islide+1, # to match Powerpoint's slide numbering
-        }
-
-        # extract text
-        text = []
-        for shp in slide.Shapes:
-            #print(shp.HasTextFrame)
-            if shp.HasTextFrame==msoTrue and shp.TextFrame.HasText==msoTrue:
-                #import pdb; pdb.set_trace()
-                text.append(shp.TextFrame.TextRange.Text)
-            if shp.Type==msoGroup:
-                text.extend(text_from_group(shp))
-        this['text'] = text
-
-        # extract images
-        this['thumb'] = render_slide(height=240) # PIL.Image object
-        this['hires'] = render_slide(height=1080)
-
-        # figure out if this slide contains anything other than text
-        this['textonly'] = not contains_types(slide.Shapes) # default is to look for non text types
-
-        # todo: serialize slide?
-
-        slides.append(this)
-
-    powerpoint.Presentations[1].Close()
-    powerpoint.Quit()
-
-    # todo: cleanup tmp dir
-
-    return slides
+def render_derivatives(hires_png):
+    """derive the thumb png and its fingerprint from the hires bytes
+    runs on a worker thread: PIL decode/encode and numpy all release the
+    GIL, so this overlaps with the next COM Export call"""
+    hires = Image.open(io.BytesIO(hires_png))
+    thumb = hires.resize(((240*hires.width)//hires.height, 240), Image.LANCZOS)
+    buf = io.BytesIO()
+    # level-1 deflate is ~3-5x faster than the default level 6 for
+    # ~25% more bytes - a good trade for blobs that never leave the db
+    thumb.save(buf, format='PNG', compress_level=1, optimize=False)
+    thumb_png = buf.getvalue()
+    return thumb_png, image_fingerprint(thumb_png)
+
+
+def extract_slides_subprocess(fn, timeout=600):
+    """render fn in a short-lived extract_worker.py process
+    powerpoint COM leaks handles and GDI memory over long runs, so each
+    file gets a fresh worker that dies clean; this process never touches
+    COM and its footprint stays flat"""
+    import pickle
+    import subprocess
+
+    worker = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'extract_worker.py')
+    outfn = os.path.join(make_temp_dir(), 'slides.pkl')
+    try:
+        subprocess.run([sys.executable, worker,
+                        '--in', os.path.abspath(fn), '--out', outfn],
+                       check=True, timeout=timeout)
+        with open(outfn, 'rb') as f:
+            return pickle.load(f)
+    finally:
+        if os.path.exists(outfn):
+            os.remove(outfn)
 
 
 def db_connect(dbfn='pptcat.db3'):
-    import sqlite3
     db = sqlite3.connect(dbfn)
     cur = db.cursor()
+    # WAL + NORMAL makes a commit roughly one fsync instead of several
+    cur.executescript("""
+      pragma journal_mode=WAL;
+      pragma synchronous=NORMAL;
+      pragma temp_store=MEMORY;
+      pragma cache_size=-65536;
+    """)
     cur.executescript(SCHEMASQL) # safe due to "if not exists"
+    # migrate libraries created before the dedupe prefilter columns
+    for coldef in ('size integer', 'head_hash text'):
+        try:
+            cur.execute('alter table files add column %s' % coldef)
+        except sqlite3.OperationalError: # duplicate column name
+            pass
     db.commit()
     db.row_factory = sqlite3.Row
     return db
@@ -154,131 +148,209 @@ def db_connect(dbfn='pptcat.db3'):
 
 def get_files_to_index():
     fns = []
+
+    def scantree(path):
+        # scandir hands back name+type straight from the dirent, so no
+        # stat() and no regex per entry (matters on very large trees)
+        try:
+            entries = os.scandir(path)
+        except OSError as err:
+            logging.warning('cannot list %s: %s', path, err)
+            return
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    scantree(entry.path)
+                elif entry.name.lower().endswith(('.ppt', '.pptx')):
+                    fns.append(entry.path)
+
     for arg in sys.argv[1:]:
         if os.path.isfile(arg):
             fns.append(arg)
         elif os.path.isdir(arg):
-            #from glob import glob
-            #fns += glob(os.path.join(arg, '**/*.ppt[x]?'), recursive=True)
-            import re
-            regexp = re.compile('^.*\.[pP][pP][tT][xX]?$')
-            for root, dirnames, filenames in os.walk(arg):
-                fns += [os.path.join(root, fn) for fn in filenames if regexp.match(fn)]
+            scantree(arg)
     return fns
 
 
 def file_checksum(fn):
-    import hashlib
-    hash_md5 = hashlib.md5()
-    with open(fn, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
+    with open(fn, "rb", buffering=0) as f:
+        if hasattr(hashlib, 'file_digest'): # python 3.11+, streams in C
+            return hashlib.file_digest(f, 'md5').hexdigest()
+        # older pythons: reusable 1 MB buffer instead of a 4 KB read per loop
+        hash_md5 = hashlib.md5()
+        buf = memoryview(bytearray(1<<20))
+        n = f.readinto(buf)
+        while n:
+            hash_md5.update(buf[:n])
+            n = f.readinto(buf)
     return hash_md5.hexdigest()
 
 
-def image_fingerprint(I):
+def head_checksum(fn, nbytes=65536):
+    """md5 of just the first nbytes - a cheap dedupe prefilter, so
+    already-indexed files don't pay a full-file hash on rerun"""
+    with open(fn, "rb") as f:
+        return hashlib.md5(f.read(nbytes)).hexdigest()
+
+
+def fetch_head_index(db):
+    """(size, head_hash) pairs of everything already in the library"""
+    cur = db.cursor()
+    cur.execute('select size, head_hash from files where head_hash is not null')
+    return set((row['size'], row['head_hash']) for row in cur)
+
+
+def fetch_known_filenames(db):
+    """absolute paths of everything already in the library"""
+    cur = db.cursor()
+    cur.execute('select filename from files')
+    return set(row['filename'] for row in cur)
+
+
+def image_fingerprint(png_bytes):
        """similarity measure
-       perceptual hash
+       64-bit dHash (horizontal gradient sign on a 9x8 greyscale reduction)
        image fingerprint
-       I is a PIL.Image
+       png_bytes is an encoded PNG; only decoded here, where pixels are needed
+       returned as a (signed) int so it fits a sqlite INTEGER and
+       near-duplicate search is one xor+popcount per row
        """
-       import imagehash
-       return str(imagehash.average_hash(I, hash_size=32))
+       img = Image.open(io.BytesIO(png_bytes))
+       arr = np.asarray(img.convert('L').resize((9, 8), Image.BOX), dtype=np.int16)
+       bits = (arr[:, 1:] > arr[:, :-1]).ravel()
+       return int(np.packbits(bits).view('<i8')[0])
 
 
-def store_file(db, fn, checksum):
+def find_similar(db, fingerprint, maxdist=6):
+    """slides whose fingerprint is within maxdist bits of the given one
+    returns [(rowid, distance), ...] ordered by distance"""
     cur = db.cursor()
-    cur.execute('insert into files(filename, hash) values(?,?)', (fn, checksum))
-    db.commit()
+    cur.execute('select rowid, fingerprint from slides where fingerprint is not null')
+    rows = cur.fetchall()
+    if not rows:
+        return []
+    rowids = np.array([row['rowid'] for row in rows], dtype=np.int64)
+    hashes = np.array([row['fingerprint'] for row in rows], dtype=np.int64)
+    diff = np.bitwise_xor(hashes, np.int64(fingerprint))
+    dist = np.unpackbits(diff.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+    hits = dist<=maxdist
+    order = np.argsort(dist[hits])
+    return list(zip(rowids[hits][order].tolist(), dist[hits][order].tolist()))
+
+
+def store_file(db, fn, checksum, size, head_hash):
+    # no commit here: process1 wraps the whole file in one transaction
+    cur = db.cursor()
+    cur.execute('insert into files(filename, hash, size, head_hash) values(?,?,?,?)',
+                (fn, checksum, size, head_hash))
     return cur.lastrowid
 
 
-def img_to_png_bytes(I):
-    import io
-    imgByteArr = io.BytesIO()
-    I.save(imgByteArr, format='PNG')
-    return imgByteArr.getvalue()
-
-
-def store_slide(db, fileid, slide):
+def store_slides(db, fileid, slides):
+    """bulk-insert all of a file's slides
+    one executemany instead of a round-trip per slide; no commit here,
+    process1 wraps the whole file in one transaction"""
     cur = db.cursor()
-    try:
-        cur.execute('insert into slides(fileid, islide, fingerprint, textonly) values(?,?,?,?)',
-                (
-                    fileid,
-                    slide['islide'],
-                    slide['fingerprint'],
-                    slide['textonly']
-                )
-        )
-    except Exception as err:
-        print(err)
-        import pdb; pdb.set_trace()
-
-    slideid = cur.lastrowid
-
-    slidebasefn = '%s_%s' % (fileid, slide['islide'])
-
-    # write text
-    with open(slidebasefn+'.txt', 'w', encoding="utf-8") as f:
-        f.write("\n\n".join(slide['text']))
-    if len(slide['text'])>0:
-        cur.execute('update slides set text=? where rowid=?', (str(slide['text']), slideid))
-
-    # store thumbenails etc if not just text
-    if not slide['textonly'] or True: # FIXME
-
-        # write thumb
-        cur.execute('update slides set thumb=? where rowid=?',
-                    (
-                        #slide['thumb'].tobytes(),
-                        img_to_png_bytes(slide['thumb']),
-                        slideid
-                    )
-        )
-        #slide['thumb'].save(slidebasefn+'_thumb.png')
-
-        # write hires
-        slide['hires'].save(slidebasefn+'.png')
-        #cur.execute('update slides set hires=? where rowid=?',
-        #            (
-        #                img_to_png_bytes(slide['hires']),
-        #                slideid
-        #            )
-        #)
 
-    db.commit()
+    # store thumbnails etc if not just text
+    def storeimages(slide):
+        return not slide['textonly'] or True # FIXME
+
+    # column-wise views of the slides; plain joined text (not a python
+    # repr of a list) so fts5 MATCH and LIKE both work on the column.
+    # hires goes in as zeroblob placeholders streamed below, so
+    # executemany never copies the big pngs
+    # insert errors must propagate: process1's rollback depends on them
+    texts = ["\n\n".join(s['text']) for s in slides]
+    hires = [s['hires_png'] if storeimages(s) else b'' for s in slides]
+    cur.executemany('insert into slides(fileid, islide, fingerprint, thumb, hires, text, textonly) values(?,?,?,?,zeroblob(?),?,?)',
+            zip(
+                (fileid for s in slides),
+                (s['islide'] for s in slides),
+                (s['fingerprint'] for s in slides),
+                (s['thumb_png'] if storeimages(s) else None for s in slides),
+                (len(png) for png in hires),
+                (text if text else None for text in texts),
+                (s['textonly'] for s in slides),
+            )
+    )
+
+    cur.execute('select islide, rowid from slides where fileid=?', (fileid,))
+    rowids = dict(cur.fetchall())
+
+    # stream each hires png into its blob in 1 MB chunks so sqlite never
+    # takes a second full copy of it
+    for slide, png in zip(slides, hires):
+        if len(png)>0:
+            slideid = rowids[slide['islide']]
+            if hasattr(db, 'blobopen'): # python 3.11+
+                with db.blobopen('slides', 'hires', slideid) as blob:
+                    mv = memoryview(png)
+                    for i in range(0, len(mv), 1<<20):
+                        blob.write(mv[i:i+(1<<20)])
+            else:
+                cur.execute('update slides set hires=? where rowid=?', (png, slideid))
 
-    return slideid, slidebasefn
+    return rowids
 
 
-def fetch_known_checksums(db):
+def search_text(db, query):
+    """full text search over slide text
+    query is fts5 MATCH syntax, e.g. 'kiln AND schedule'
+    returns (fileid, islide) rows"""
     cur = db.cursor()
-    cur.execute('select hash from files')
-    return [row['hash'] for row in cur]
+    cur.execute("""
+        select slides.fileid, slides.islide
+        from slides_fts join slides on slides.rowid=slides_fts.rowid
+        where slides_fts match ?
+    """, (query,))
+    return cur.fetchall()
 
 
-def process1(db, fn, known_checksums):
+def process1(db, fn, head_index, known_files, head=None):
     logging.info('processing %s...', fn)
 
-    # check that this ppt hasn't been indexed previously based on file md5
+    # dedupe prefilter: a (size, 64 KB head md5) miss means certainly new.
+    # a hit is only trusted outright for a path already in the library
+    # (the rerun-over-an-indexed-tree case); a hit on a NEW path could be
+    # two decks sharing size and first 64 KB, so it still has to pass the
+    # full-md5 check below before being dismissed
+    size = os.path.getsize(fn)
+    if head is None:
+        head = head_checksum(fn)
+    if (size, head) in head_index and os.path.abspath(fn) in known_files:
+        logging.warning('skipping duplicate %s (already in library)', fn)
+        return
+
+    # full-file md5, for the dedupe check and the record (the unique
+    # index on files.hash backstops it)
     checksum = file_checksum(fn)
-    if checksum in known_checksums:
+    cur = db.cursor()
+    if cur.execute('select 1 from files where hash=? limit 1', (checksum,)).fetchone():
         logging.warning('skipping duplicate %s', fn)
         return
 
-    # write file to library & update known_checksums
-    fileid = store_file(db, os.path.abspath(fn), checksum)
-    known_checksums.append(checksum)
-
     # extract: render (thumbnail, hires), text fragments, serialize?
-    slides = extract_slides(fn)
+    # the worker also derives thumbs/fingerprints while its slides render
+    slides = extract_slides_subprocess(fn)
 
-    # write slides to library
-    for slide in slides:
-        slide['fingerprint'] = image_fingerprint(slide['thumb'])
-        slideid, outbasefn = store_slide(db, fileid, slide)
-        logging.info('wrote slide %s::%s -> %s', fn, slide['islide'], outbasefn)
+    # all writing for a ppt file is a single transaction; this process is
+    # the only sqlite writer, so no lock contention with the pool
+    try:
+        # write file to library
+        fileid = store_file(db, os.path.abspath(fn), checksum, size, head)
+
+        # write slides to library in one bulk insert
+        store_slides(db, fileid, slides)
+        logging.info('wrote %s slides from %s', len(slides), fn)
+
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    head_index.add((size, head))
+    known_files.add(os.path.abspath(fn))
 
 
 def main():
@@ -288,16 +360,34 @@ def main():
     # get list of folders/files to index
     fns = get_files_to_index()
 
-    # init checksums
-    known_checksums = fetch_known_checksums(db)
-    logging.info('library knows of %s ppt/pptx files', len(known_checksums))
-
-    # for each file to index
-    for fn in fns:
-        try:
-            process1(db, fn, known_checksums)
-        except Exception as err:
-            logging.warning('%s failed: %s', fn, err)
+    nknown = db.execute('select count(*) from files').fetchone()[0]
+    logging.info('library knows of %s ppt/pptx files', nknown)
+
+    head_index = fetch_head_index(db)
+    known_files = fetch_known_filenames(db)
+
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as procs:
+
+        # head-hash everything up front, ahead of the powerpoint work;
+        # only files that clear the prefilter pay a full-file md5 later.
+        # one future per file so a locked/vanished file doesn't abort the
+        # whole precompute: it maps to None and process1 retries (and
+        # reports) it inside the per-file try below
+        futures = {fn: procs.submit(head_checksum, fn) for fn in fns}
+        heads = {}
+        for fn, future in futures.items():
+            try:
+                heads[fn] = future.result()
+            except OSError as err:
+                logging.debug('head hash of %s failed: %s', fn, err)
+                heads[fn] = None
+
+        # for each file to index
+        for fn in fns:
+            try:
+                process1(db, fn, head_index, known_files, head=heads[fn])
+            except Exception as err:
+                logging.warning('%s failed: %s', fn, err)
 
 if __name__=="__main__":
     main()